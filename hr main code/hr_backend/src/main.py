@@ -3,14 +3,38 @@ import sys
 # DON'T CHANGE THIS !!!
 sys.path.insert(0, os.path.dirname(os.path.dirname(__file__)))
 
-from flask import Flask, send_from_directory
+import orjson
+from flask import Flask, request, send_from_directory
+from flask.json.provider import DefaultJSONProvider
 from flask_jwt_extended import JWTManager
 from flask_cors import CORS
+from whitenoise import WhiteNoise
+from sqlalchemy import event, select, func
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import selectinload
+from sqlalchemy.schema import CreateIndex
 from src.models.user import db, bcrypt
 from src.routes.user import user_bp
-from src.routes.auth import auth_bp, check_if_token_revoked
+from src.routes.auth import (
+    auth_bp, check_if_token_revoked, user_identity_lookup, user_lookup_callback,
+    user_lookup_error_callback
+)
+
+class OrjsonProvider(DefaultJSONProvider):
+    """JSON provider backed by orjson, which also serializes datetimes natively"""
+
+    # Naive datetimes are UTC throughout; non-string keys, e.g. ids, are
+    # stringified the way the stdlib encoder does instead of raising
+    options = orjson.OPT_NAIVE_UTC | orjson.OPT_NON_STR_KEYS
+
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj, default=self.default, option=self.options).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
 
 app = Flask(__name__, static_folder=os.path.join(os.path.dirname(__file__), 'static'))
+app.json = OrjsonProvider(app)
 app.config['SECRET_KEY'] = 'asdf#FGSgvasgf$5$WGT'
 app.config['JWT_SECRET_KEY'] = 'jwt-secret-string-change-in-production'
 
@@ -22,6 +46,11 @@ CORS(app)
 # JWT token blacklist checker
 jwt.token_in_blocklist_loader(check_if_token_revoked)
 
+# JWT user loaders, giving routes a preloaded current_user
+jwt.user_identity_loader(user_identity_lookup)
+jwt.user_lookup_loader(user_lookup_callback)
+jwt.user_lookup_error_loader(user_lookup_error_callback)
+
 # Register blueprints
 from src.routes.role import role_bp
 app.register_blueprint(auth_bp, url_prefix='/api/auth')
@@ -31,11 +60,64 @@ app.register_blueprint(role_bp, url_prefix='/api')
 # Database configuration
 app.config['SQLALCHEMY_DATABASE_URI'] = f"sqlite:///{os.path.join(os.path.dirname(__file__), 'database', 'app.db')}"
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+# Make unplanned lazy loads raise; meant for development and tests only
+app.config['SQLALCHEMY_RAISELOAD'] = os.environ.get('SQLALCHEMY_RAISELOAD') == '1'
+# LIFO checkout reuses the most recently returned connections so idle ones can
+# time out after a burst; recycling avoids handing out stale connections
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
+    'pool_size': 20,
+    'max_overflow': 40,
+    'pool_pre_ping': True,
+    'pool_recycle': 1800,
+    'pool_use_lifo': True,
+    'connect_args': {'check_same_thread': False, 'timeout': 30}
+}
 db.init_app(app)
 
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    """Enable WAL so readers don't block on a committing writer"""
+    cursor = dbapi_connection.cursor()
+    cursor.execute('PRAGMA journal_mode=WAL')
+    cursor.execute('PRAGMA synchronous=NORMAL')
+    cursor.execute('PRAGMA temp_store=MEMORY')
+    cursor.execute('PRAGMA mmap_size=268435456')
+    cursor.close()
+
+def create_missing_indexes():
+    """Create indexes added to existing tables, which create_all() skips"""
+    # IF NOT EXISTS rather than checkfirst, since reflection can't see
+    # expression indexes such as the lower() ones on user
+    try:
+        with db.engine.begin() as connection:
+            for table in db.metadata.sorted_tables:
+                for index in table.indexes:
+                    connection.execute(CreateIndex(index, if_not_exists=True))
+    except IntegrityError as e:
+        # A unique index can't be built over rows that already clash; name
+        # them so the accounts can be renamed or merged before restarting
+        duplicates = find_case_duplicates()
+        if not duplicates:
+            raise
+        raise RuntimeError(
+            'Cannot create the case-insensitive unique indexes on user: these '
+            f'usernames/emails differ only by case: {", ".join(duplicates)}. '
+            'Rename or merge those accounts, then restart.'
+        ) from e
+
+def find_case_duplicates():
+    """List usernames and emails shared, ignoring case, by more than one user"""
+    from src.models.user import User
+    
+    duplicates = []
+    for column in (User.username, User.email):
+        duplicates += db.session.scalars(
+            select(func.lower(column)).group_by(func.lower(column)).having(func.count() > 1)
+        )
+    return duplicates
+
 def init_database():
     """Initialize database with default roles and permissions"""
-    from src.models.user import Role, Permission
+    from src.models.user import Role, Permission, ADMIN_ROLE_NAME
     
     # Create default permissions
     permissions_data = [
@@ -50,70 +132,72 @@ def init_database():
         ('permission_delete', 'Delete permissions'),
     ]
     
-    for perm_name, perm_desc in permissions_data:
-        if not Permission.query.filter_by(name=perm_name).first():
-            permission = Permission(name=perm_name, description=perm_desc)
-            db.session.add(permission)
+    existing_permissions = set(db.session.scalars(select(Permission.name)))
+    db.session.bulk_save_objects([
+        Permission(name=perm_name, description=perm_desc)
+        for perm_name, perm_desc in permissions_data
+        if perm_name not in existing_permissions
+    ])
     
     # Create default roles
     roles_data = [
-        ('Admin', 'System administrator with full access'),
+        (ADMIN_ROLE_NAME, 'System administrator with full access'),
         ('HR', 'Human resources manager'),
         ('Employee', 'Regular employee'),
     ]
     
-    for role_name, role_desc in roles_data:
-        if not Role.query.filter_by(name=role_name).first():
-            role = Role(name=role_name, description=role_desc)
-            db.session.add(role)
-    
-    db.session.commit()
+    existing_roles = set(db.session.scalars(select(Role.name)))
+    db.session.bulk_save_objects([
+        Role(name=role_name, description=role_desc)
+        for role_name, role_desc in roles_data
+        if role_name not in existing_roles
+    ])
     
     # Assign permissions to roles
-    admin_role = Role.query.filter_by(name='Admin').first()
-    hr_role = Role.query.filter_by(name='HR').first()
-    employee_role = Role.query.filter_by(name='Employee').first()
+    roles = {
+        role.name: role
+        for role in Role.query.options(selectinload(Role.permissions)).filter(
+            Role.name.in_([role_name for role_name, _ in roles_data])
+        )
+    }
+    all_permissions = Permission.query.all()
+    permissions_by_name = {permission.name: permission for permission in all_permissions}
     
-    if admin_role:
+    if ADMIN_ROLE_NAME in roles:
         # Admin gets all permissions
-        all_permissions = Permission.query.all()
-        admin_role.permissions = all_permissions
+        roles[ADMIN_ROLE_NAME].permissions = all_permissions
     
-    if hr_role:
+    if 'HR' in roles:
         # HR gets user management permissions
-        hr_permissions = Permission.query.filter(
-            Permission.name.in_(['user_read', 'user_write', 'role_read'])
-        ).all()
-        hr_role.permissions = hr_permissions
+        roles['HR'].permissions = [
+            permissions_by_name[name] for name in ['user_read', 'user_write', 'role_read']
+        ]
     
-    if employee_role:
+    if 'Employee' in roles:
         # Employee gets basic read permissions
-        employee_permissions = Permission.query.filter(
-            Permission.name.in_(['user_read'])
-        ).all()
-        employee_role.permissions = employee_permissions
+        roles['Employee'].permissions = [permissions_by_name['user_read']]
     
     db.session.commit()
 
 with app.app_context():
+    event.listen(db.engine, 'connect', set_sqlite_pragmas)
     db.create_all()
+    create_missing_indexes()
     init_database()
 
-@app.route('/', defaults={'path': ''})
-@app.route('/<path:path>')
-def serve(path):
-    static_folder_path = app.static_folder
-    if static_folder_path is None:
-            return "Static folder not configured", 404
-
-    if path != "" and os.path.exists(os.path.join(static_folder_path, path)):
-        return send_from_directory(static_folder_path, path)
-    else:
-        index_path = os.path.join(static_folder_path, 'index.html')
-        if os.path.exists(index_path):
-            return send_from_directory(static_folder_path, 'index.html')
-        else:
-            return "index.html not found", 404
+# Static files are served by WhiteNoise ahead of Flask routing; the hashed
+# bundles under /assets/ never change, so browsers may cache them forever
+app.wsgi_app = WhiteNoise(
+    app.wsgi_app, root=app.static_folder, index_file=True,
+    immutable_file_test=r'^/assets/'
+)
+
+@app.errorhandler(404)
+def serve_spa(error):
+    """Return index.html for client-side routes that match no static file"""
+    if request.path.startswith('/api/') or not request.accept_mimetypes.accept_html:
+        return error
+    return send_from_directory(app.static_folder, 'index.html')
 
 
 if __name__ == '__main__':
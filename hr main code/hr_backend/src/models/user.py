@@ -1,10 +1,26 @@
+import os
+from flask import current_app
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import select, func
+from sqlalchemy.orm import joinedload, raiseload
 from datetime import datetime
+from operator import attrgetter
+from concurrent.futures import ThreadPoolExecutor
 from flask_bcrypt import Bcrypt
+from argon2 import PasswordHasher
+from argon2.exceptions import InvalidHashError, VerificationError
 
 db = SQLAlchemy()
 bcrypt = Bcrypt()
 
+# Argon2id at the OWASP baseline (46 MiB, t=1, p=1); bcrypt is kept only to verify legacy hashes
+password_hasher = PasswordHasher(time_cost=1, memory_cost=47104, parallelism=1)
+
+# Both hash libraries release the GIL, so running them on a pool sized to the
+# CPU count keeps a slow hash from blocking the other threads of a worker and
+# lets several hashes run in parallel
+_hash_pool = ThreadPoolExecutor(max_workers=os.cpu_count(), thread_name_prefix='password-hash')
+
 # Association table for many-to-many relationship between User and Role
 user_roles = db.Table('user_roles',
     db.Column('user_id', db.Integer, db.ForeignKey('user.id'), primary_key=True),
@@ -19,6 +35,47 @@ role_permissions = db.Table('role_permissions',
     db.Column('created_at', db.DateTime, default=datetime.utcnow)
 )
 
+# Reverse-order indexes; the composite primary keys only cover lookups by user_id
+# and role_id respectively, so queries by role or by permission would scan
+db.Index('ix_user_roles_role', user_roles.c.role_id, user_roles.c.user_id)
+db.Index('ix_role_perms_perm', role_permissions.c.permission_id, role_permissions.c.role_id)
+
+# Serialized fields for to_dict, each read with a single attrgetter call per row
+USER_FIELDS = ('id', 'username', 'email', 'first_name', 'last_name', 'is_active',
+               'created_at', 'updated_at')
+ROLE_FIELDS = ('id', 'name', 'description')
+PERMISSION_FIELDS = ('id', 'name', 'description')
+_user_attrs = attrgetter(*USER_FIELDS)
+_role_attrs = attrgetter(*ROLE_FIELDS)
+_permission_attrs = attrgetter(*PERMISSION_FIELDS)
+
+# Granted every permission by init_database, so checks can stop at the role
+ADMIN_ROLE_NAME = 'Admin'
+
+def hash_password(password):
+    """Hash a password with Argon2id on the hashing pool"""
+    return _hash_pool.submit(password_hasher.hash, password).result()
+
+def hash_passwords(passwords):
+    """Hash several passwords in parallel on the hashing pool"""
+    return list(_hash_pool.map(password_hasher.hash, passwords))
+
+def verify_password(password_hash, password):
+    """Check a password against an Argon2id or legacy bcrypt hash on the hashing pool"""
+    return _hash_pool.submit(_verify_password, password_hash, password).result()
+
+def _verify_password(password_hash, password):
+    if password_hash.startswith('$2'):
+        return bcrypt.check_password_hash(password_hash, password)
+    try:
+        return password_hasher.verify(password_hash, password)
+    except (VerificationError, InvalidHashError):
+        return False
+
+def password_needs_rehash(password_hash):
+    """Check if a hash is legacy bcrypt or uses outdated Argon2 parameters"""
+    return password_hash.startswith('$2') or password_hasher.check_needs_rehash(password_hash)
+
 class User(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     username = db.Column(db.String(80), unique=True, nullable=False)
@@ -31,7 +88,7 @@ class User(db.Model):
     updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
     
     # Many-to-many relationship with Role
-    roles = db.relationship('Role', secondary=user_roles, lazy='subquery',
+    roles = db.relationship('Role', secondary=user_roles, lazy='raise',
                            backref=db.backref('users', lazy=True))
 
     def __repr__(self):
@@ -39,64 +96,59 @@ class User(db.Model):
 
     def set_password(self, password):
         """Hash and set the user's password"""
-        self.password = bcrypt.generate_password_hash(password).decode('utf-8')
+        self.password = hash_password(password)
 
     def check_password(self, password):
-        """Check if the provided password matches the user's password"""
-        return bcrypt.check_password_hash(self.password, password)
-
-    def has_permission(self, permission_name):
-        """Check if user has a specific permission through their roles"""
-        for role in self.roles:
-            for permission in role.permissions:
-                if permission.name == permission_name:
-                    return True
-        return False
-
-    def get_permissions(self):
+        """Check if the provided password matches, upgrading an outdated hash on success"""
+        if not verify_password(self.password, password):
+            return False
+        if password_needs_rehash(self.password):
+            self.set_password(password)
+        return True
+
+    @property
+    def is_admin(self):
+        """Check if user holds the Admin role, which grants every permission"""
+        return any(role.name == ADMIN_ROLE_NAME for role in self.roles)
+
+    def get_permissions(self, role_summaries=None):
         """Get all permissions for this user through their roles"""
         permissions = set()
         for role in self.roles:
-            for permission in role.permissions:
-                permissions.add(permission.name)
+            permissions.update(role_summary(role, role_summaries)[1])
         return list(permissions)
 
-    def to_dict(self, include_roles=False):
-        user_dict = {
-            'id': self.id,
-            'username': self.username,
-            'email': self.email,
-            'first_name': self.first_name,
-            'last_name': self.last_name,
-            'is_active': self.is_active,
-            'created_at': self.created_at.isoformat() if self.created_at else None,
-            'updated_at': self.updated_at.isoformat() if self.updated_at else None
-        }
+    def to_dict(self, include_roles=False, minimal=False, role_summaries=None):
+        if minimal:
+            return {'id': self.id, 'username': self.username}
+        
+        user_dict = dict(zip(USER_FIELDS, _user_attrs(self)))
         
         if include_roles:
-            user_dict['roles'] = [role.to_dict() for role in self.roles]
-            user_dict['permissions'] = self.get_permissions()
+            user_dict['roles'] = [role_summary(role, role_summaries)[0] for role in self.roles]
+            user_dict['permissions'] = self.get_permissions(role_summaries)
         
         return user_dict
 
+# Usernames and emails are unique regardless of case; these expression indexes
+# enforce that and serve the case-insensitive lookups in login and signup
+db.Index('ix_user_username_lower', func.lower(User.username), unique=True)
+db.Index('ix_user_email_lower', func.lower(User.email), unique=True)
+
 class Role(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(80), unique=True, nullable=False)
     description = db.Column(db.Text, nullable=True)
     
     # Many-to-many relationship with Permission
-    permissions = db.relationship('Permission', secondary=role_permissions, lazy='subquery',
+    permissions = db.relationship('Permission', secondary=role_permissions, lazy='raise',
                                  backref=db.backref('roles', lazy=True))
 
     def __repr__(self):
         return f'<Role {self.name}>'
 
     def to_dict(self, include_permissions=False):
-        role_dict = {
-            'id': self.id,
-            'name': self.name,
-            'description': self.description
-        }
+        role_dict = dict(zip(ROLE_FIELDS, _role_attrs(self)))
         
         if include_permissions:
             role_dict['permissions'] = [permission.to_dict() for permission in self.permissions]
@@ -112,8 +164,64 @@ class Permission(db.Model):
         return f'<Permission {self.name}>'
 
     def to_dict(self):
-        return {
-            'id': self.id,
-            'name': self.name,
-            'description': self.description
-        }
+        return dict(zip(PERMISSION_FIELDS, _permission_attrs(self)))
+
+def record_exists(model, *criteria):
+    """Check for a matching row with SELECT EXISTS instead of loading it"""
+    return db.session.execute(select(select(model.id).where(*criteria).exists())).scalar()
+
+# Columns and indexes named by SQLite's UNIQUE constraint errors, mapped to the
+# field reported back to the client
+UNIQUE_CONSTRAINT_FIELDS = {
+    'user.username': 'username',
+    "index 'ix_user_username_lower'": 'username',
+    'user.email': 'email',
+    "index 'ix_user_email_lower'": 'email',
+    'role.name': 'name',
+    'permission.name': 'name',
+}
+
+def duplicate_field(error):
+    """Name the field whose UNIQUE constraint an IntegrityError violated, if any"""
+    message = str(error.orig)
+    prefix = 'UNIQUE constraint failed: '
+    if not message.startswith(prefix):
+        return None
+    return UNIQUE_CONSTRAINT_FIELDS.get(message[len(prefix):])
+
+def role_summary(role, summaries=None):
+    """Get a role's serialized dict and permission names
+
+    Listings repeat the same few roles for every user, so they pass a dict
+    of their own to serialize each role once while building the response.
+    """
+    summary = summaries.get(role.id) if summaries is not None else None
+    if summary is None:
+        summary = (role.to_dict(), frozenset(permission.name for permission in role.permissions))
+        if summaries is not None:
+            summaries[role.id] = summary
+    return summary
+
+def raiseload_guard():
+    """Loader options that make any relationship not eagerly loaded raise on access
+
+    Enabled with the SQLALCHEMY_RAISELOAD config flag in development and tests,
+    so a new lazy load on a hot path fails loudly instead of adding queries.
+    """
+    return [raiseload('*')] if current_app.config.get('SQLALCHEMY_RAISELOAD') else []
+
+def load_user(user_id):
+    """Fetch a user with roles and their permissions eagerly loaded in one joined query"""
+    return db.session.get(
+        User, user_id,
+        options=[joinedload(User.roles).joinedload(Role.permissions), *raiseload_guard()],
+        populate_existing=True
+    )
+
+def load_role(role_id):
+    """Fetch a role with its permissions eagerly loaded in one joined query"""
+    return db.session.get(
+        Role, role_id,
+        options=[joinedload(Role.permissions), *raiseload_guard()],
+        populate_existing=True
+    )
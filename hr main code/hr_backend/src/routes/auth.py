@@ -1,258 +1,240 @@
 from flask import Blueprint, jsonify, request
-from flask_jwt_extended import create_access_token, jwt_required, get_jwt_identity, get_jwt
-from src.models.user import User, Role, db
+from flask_jwt_extended import create_access_token, jwt_required, get_jwt, current_user
+from sqlalchemy import select, func
+from src.models.user import (
+    User, Role, db, load_user, record_exists, verify_password, password_needs_rehash
+)
+from src.routes.errors import register_error_handlers
 from datetime import timedelta
+import os
+import time
+import redis
 import secrets
-import string
 
 auth_bp = Blueprint('auth', __name__)
+register_error_handlers(auth_bp)
 
-# In-memory store for blacklisted tokens (in production, use Redis or database)
-blacklisted_tokens = set()
+# Redis store for blacklisted tokens and password reset tokens, shared by all workers
+redis_client = redis.Redis.from_url(
+    os.environ.get('REDIS_URL', 'redis://localhost:6379/0'),
+    decode_responses=True
+)
+
+RESET_TOKEN_TTL = 900  # seconds
 
 @auth_bp.route('/register', methods=['POST'])
 def register():
     """Register a new user"""
-    try:
-        data = request.get_json()
-        
-        # Validate required fields
-        required_fields = ['username', 'email', 'password']
-        for field in required_fields:
-            if not data.get(field):
-                return jsonify({'error': f'{field} is required'}), 400
-        
-        # Check if user already exists
-        if User.query.filter_by(username=data['username']).first():
-            return jsonify({'error': 'Username already exists'}), 400
-        
-        if User.query.filter_by(email=data['email']).first():
-            return jsonify({'error': 'Email already exists'}), 400
-        
-        # Create new user
-        user = User(
-            username=data['username'],
-            email=data['email'],
-            first_name=data.get('first_name', ''),
-            last_name=data.get('last_name', '')
-        )
-        user.set_password(data['password'])
-        
-        # Assign default role (Employee) if exists
-        default_role = Role.query.filter_by(name='Employee').first()
-        if default_role:
-            user.roles.append(default_role)
-        
-        db.session.add(user)
-        db.session.commit()
-        
-        return jsonify({
-            'message': 'User registered successfully',
-            'user': user.to_dict(include_roles=True)
-        }), 201
-        
-    except Exception as e:
-        db.session.rollback()
-        return jsonify({'error': str(e)}), 500
+    data = request.get_json()
+    
+    # Validate required fields
+    required_fields = ['username', 'email', 'password']
+    for field in required_fields:
+        if not data.get(field):
+            return jsonify({'error': f'{field} is required'}), 400
+    
+    # Check if user already exists
+    if record_exists(User, func.lower(User.username) == func.lower(data['username'])):
+        return jsonify({'error': 'Username already exists'}), 400
+    
+    if record_exists(User, func.lower(User.email) == func.lower(data['email'])):
+        return jsonify({'error': 'Email already exists'}), 400
+    
+    # Create new user
+    user = User(
+        username=data['username'],
+        email=data['email'],
+        first_name=data.get('first_name', ''),
+        last_name=data.get('last_name', '')
+    )
+    user.set_password(data['password'])
+    
+    # Assign default role (Employee) if exists
+    default_role = Role.query.filter_by(name='Employee').first()
+    if default_role:
+        user.roles.append(default_role)
+    
+    db.session.add(user)
+    db.session.commit()
+    user = load_user(user.id)
+    
+    return jsonify({
+        'message': 'User registered successfully',
+        'user': user.to_dict(include_roles=True)
+    }), 201
 
 @auth_bp.route('/login', methods=['POST'])
 def login():
     """Authenticate user and return JWT token"""
-    try:
-        data = request.get_json()
-        
-        # Validate required fields
-        if not data.get('username') or not data.get('password'):
-            return jsonify({'error': 'Username and password are required'}), 400
-        
-        # Find user by username or email
-        user = User.query.filter(
-            (User.username == data['username']) | (User.email == data['username'])
-        ).first()
-        
-        if not user or not user.check_password(data['password']):
-            return jsonify({'error': 'Invalid credentials'}), 401
-        
-        if not user.is_active:
-            return jsonify({'error': 'Account is deactivated'}), 401
-        
-        # Create access token with string identity
-        access_token = create_access_token(
-            identity=str(user.id),
-            expires_delta=timedelta(hours=24)
-        )
-        
-        return jsonify({
-            'message': 'Login successful',
-            'access_token': access_token,
-            'user': user.to_dict(include_roles=True)
-        }), 200
-        
-    except Exception as e:
-        return jsonify({'error': str(e)}), 500
+    data = request.get_json()
+    
+    # Validate required fields
+    if not data.get('username') or not data.get('password'):
+        return jsonify({'error': 'Username and password are required'}), 400
+    
+    # Find user by username or email, ignoring case, via the lower() indexes
+    identifier = func.lower(data['username'])
+    credentials = select(User.id, User.password, User.is_active).where(
+        func.lower(User.username) == identifier
+    ).union_all(
+        select(User.id, User.password, User.is_active).where(func.lower(User.email) == identifier)
+    ).limit(1)
+    account = db.session.execute(credentials).first()
+    
+    if not account or not verify_password(account.password, data['password']):
+        return jsonify({'error': 'Invalid credentials'}), 401
+    
+    if not account.is_active:
+        return jsonify({'error': 'Account is deactivated'}), 401
+    
+    user = load_user(account.id)
+    
+    # Upgrade a legacy or outdated hash while the plain password is at hand
+    if password_needs_rehash(account.password):
+        user.set_password(data['password'])
+        db.session.commit()
+        user = load_user(user.id)
+    
+    # Create access token; the identity loader stores the user's id
+    access_token = create_access_token(
+        identity=user,
+        expires_delta=timedelta(hours=24)
+    )
+    
+    return jsonify({
+        'message': 'Login successful',
+        'access_token': access_token,
+        'user': user.to_dict(include_roles=True)
+    }), 200
 
 @auth_bp.route('/logout', methods=['POST'])
 @jwt_required()
 def logout():
     """Logout user by blacklisting the JWT token"""
-    try:
-        jti = get_jwt()['jti']  # JWT ID
-        blacklisted_tokens.add(jti)
-        
-        return jsonify({'message': 'Successfully logged out'}), 200
-        
-    except Exception as e:
-        return jsonify({'error': str(e)}), 500
+    jwt_payload = get_jwt()
+    # Keep the entry only as long as the token itself would stay valid
+    ttl = max(jwt_payload['exp'] - int(time.time()), 1)
+    redis_client.setex(f"jwt:bl:{jwt_payload['jti']}", ttl, '1')
+    
+    return jsonify({'message': 'Successfully logged out'}), 200
 
 @auth_bp.route('/profile', methods=['GET'])
 @jwt_required()
 def get_profile():
     """Get current user's profile"""
-    try:
-        user_id = int(get_jwt_identity())  # Convert to int
-        user = User.query.get(user_id)
-        
-        if not user:
-            return jsonify({'error': 'User not found'}), 404
-        
-        return jsonify({
-            'user': user.to_dict(include_roles=True)
-        }), 200
-        
-    except Exception as e:
-        return jsonify({'error': str(e)}), 500
+    return jsonify({
+        'user': current_user.to_dict(include_roles=True)
+    }), 200
 
 @auth_bp.route('/profile', methods=['PUT'])
 @jwt_required()
 def update_profile():
     """Update current user's profile"""
-    try:
-        user_id = int(get_jwt_identity())  # Convert to int
-        user = User.query.get(user_id)
-        
-        if not user:
-            return jsonify({'error': 'User not found'}), 404
-        
-        data = request.get_json()
-        
-        # Update allowed fields
-        if 'first_name' in data:
-            user.first_name = data['first_name']
-        if 'last_name' in data:
-            user.last_name = data['last_name']
-        if 'email' in data:
-            # Check if email is already taken by another user
-            existing_user = User.query.filter(User.email == data['email'], User.id != user_id).first()
-            if existing_user:
-                return jsonify({'error': 'Email already exists'}), 400
-            user.email = data['email']
-        
-        db.session.commit()
-        
-        return jsonify({
-            'message': 'Profile updated successfully',
-            'user': user.to_dict(include_roles=True)
-        }), 200
-        
-    except Exception as e:
-        db.session.rollback()
-        return jsonify({'error': str(e)}), 500
+    user = current_user
+    data = request.get_json()
+    
+    # Update allowed fields
+    if 'first_name' in data:
+        user.first_name = data['first_name']
+    if 'last_name' in data:
+        user.last_name = data['last_name']
+    if 'email' in data:
+        # Check if email is already taken by another user
+        if record_exists(User, func.lower(User.email) == func.lower(data['email']), User.id != user.id):
+            return jsonify({'error': 'Email already exists'}), 400
+        user.email = data['email']
+    
+    db.session.commit()
+    user = load_user(user.id)
+    
+    return jsonify({
+        'message': 'Profile updated successfully',
+        'user': user.to_dict(include_roles=True)
+    }), 200
 
 @auth_bp.route('/change-password', methods=['POST'])
 @jwt_required()
 def change_password():
     """Change user's password"""
-    try:
-        user_id = int(get_jwt_identity())  # Convert to int
-        user = User.query.get(user_id)
-        
-        if not user:
-            return jsonify({'error': 'User not found'}), 404
-        
-        data = request.get_json()
-        
-        if not data.get('current_password') or not data.get('new_password'):
-            return jsonify({'error': 'Current password and new password are required'}), 400
-        
-        # Verify current password
-        if not user.check_password(data['current_password']):
-            return jsonify({'error': 'Current password is incorrect'}), 400
-        
-        # Set new password
-        user.set_password(data['new_password'])
-        db.session.commit()
-        
-        return jsonify({'message': 'Password changed successfully'}), 200
-        
-    except Exception as e:
-        db.session.rollback()
-        return jsonify({'error': str(e)}), 500
-
-# In-memory store for password reset tokens (in production, use Redis or database)
-reset_tokens = {}
+    user = current_user
+    data = request.get_json()
+    
+    if not data.get('current_password') or not data.get('new_password'):
+        return jsonify({'error': 'Current password and new password are required'}), 400
+    
+    # Verify current password
+    if not user.check_password(data['current_password']):
+        return jsonify({'error': 'Current password is incorrect'}), 400
+    
+    # Set new password
+    user.set_password(data['new_password'])
+    db.session.commit()
+    
+    return jsonify({'message': 'Password changed successfully'}), 200
 
 @auth_bp.route('/forgot-password', methods=['POST'])
 def forgot_password():
     """Generate password reset token"""
-    try:
-        data = request.get_json()
-        
-        if not data.get('email'):
-            return jsonify({'error': 'Email is required'}), 400
-        
-        user = User.query.filter_by(email=data['email']).first()
-        
-        if not user:
-            # Don't reveal if email exists or not for security
-            return jsonify({'message': 'If the email exists, a reset token has been generated'}), 200
-        
-        # Generate reset token
-        token = ''.join(secrets.choice(string.ascii_letters + string.digits) for _ in range(32))
-        reset_tokens[token] = user.id
-        
-        # In a real application, you would send this token via email
-        # For demo purposes, we'll return it in the response
-        return jsonify({
-            'message': 'Password reset token generated',
-            'reset_token': token  # Remove this in production
-        }), 200
-        
-    except Exception as e:
-        return jsonify({'error': str(e)}), 500
+    data = request.get_json()
+    
+    if not data.get('email'):
+        return jsonify({'error': 'Email is required'}), 400
+    
+    user = User.query.filter(func.lower(User.email) == func.lower(data['email'])).first()
+    
+    if not user:
+        # Don't reveal if email exists or not for security
+        return jsonify({'message': 'If the email exists, a reset token has been generated'}), 200
+    
+    # Generate reset token
+    token = secrets.token_urlsafe(24)
+    redis_client.setex(f'pwreset:{token}', RESET_TOKEN_TTL, user.id)
+    
+    # In a real application, you would send this token via email
+    # For demo purposes, we'll return it in the response
+    return jsonify({
+        'message': 'Password reset token generated',
+        'reset_token': token  # Remove this in production
+    }), 200
 
 @auth_bp.route('/reset-password', methods=['POST'])
 def reset_password():
     """Reset password using token"""
-    try:
-        data = request.get_json()
-        
-        if not data.get('token') or not data.get('new_password'):
-            return jsonify({'error': 'Token and new password are required'}), 400
-        
-        # Verify token
-        user_id = reset_tokens.get(data['token'])
-        if not user_id:
-            return jsonify({'error': 'Invalid or expired token'}), 400
-        
-        user = User.query.get(user_id)
-        if not user:
-            return jsonify({'error': 'User not found'}), 404
-        
-        # Set new password
-        user.set_password(data['new_password'])
-        db.session.commit()
-        
-        # Remove used token
-        del reset_tokens[data['token']]
-        
-        return jsonify({'message': 'Password reset successfully'}), 200
-        
-    except Exception as e:
-        db.session.rollback()
-        return jsonify({'error': str(e)}), 500
+    data = request.get_json()
+    
+    if not data.get('token') or not data.get('new_password'):
+        return jsonify({'error': 'Token and new password are required'}), 400
+    
+    # Verify and consume token
+    user_id = redis_client.getdel(f"pwreset:{data['token']}")
+    if not user_id:
+        return jsonify({'error': 'Invalid or expired token'}), 400
+    
+    user = db.session.get(User, int(user_id))
+    if not user:
+        return jsonify({'error': 'User not found'}), 404
+    
+    # Set new password
+    user.set_password(data['new_password'])
+    db.session.commit()
+    
+    return jsonify({'message': 'Password reset successfully'}), 200
 
 # JWT token blacklist checker
 def check_if_token_revoked(jwt_header, jwt_payload):
     """Check if JWT token is blacklisted"""
     jti = jwt_payload['jti']
-    return jti in blacklisted_tokens
\ No newline at end of file
+    return bool(redis_client.exists(f'jwt:bl:{jti}'))
+
+# JWT user loaders
+def user_identity_lookup(user):
+    """Store the user's id as the JWT identity"""
+    return str(user.id)
+
+def user_lookup_callback(jwt_header, jwt_payload):
+    """Load the JWT user with roles and permissions, once per request"""
+    return load_user(int(jwt_payload['sub']))
+
+def user_lookup_error_callback(jwt_header, jwt_payload):
+    """Handle tokens whose user no longer exists"""
+    return jsonify({'error': 'User not found'}), 404
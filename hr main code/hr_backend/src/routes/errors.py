@@ -0,0 +1,46 @@
+import msgspec
+from flask import jsonify
+from werkzeug.exceptions import HTTPException
+from sqlalchemy.exc import IntegrityError, SQLAlchemyError
+from src.models.user import db, duplicate_field
+
+def handle_not_found(e):
+    """Return a JSON 404 for rows looked up with get_or_404"""
+    return jsonify({'error': 'Resource not found'}), 404
+
+def handle_http_error(e):
+    """Return other HTTP errors, e.g. a 415 for a non-JSON body, as JSON"""
+    return jsonify({'error': e.description}), e.code
+
+def handle_invalid_payload(e):
+    """Report a request body that failed msgspec decoding or validation"""
+    return jsonify({'error': str(e)}), 400
+
+def handle_integrity_error(e):
+    """Roll back and report a constraint violation as a bad request"""
+    db.session.rollback()
+    field = duplicate_field(e)
+    if field:
+        return jsonify({'error': f'{field.capitalize()} already exists'}), 400
+    return jsonify({'error': 'Request conflicts with existing data'}), 400
+
+def handle_database_error(e):
+    """Roll back the failed transaction without echoing driver details"""
+    db.session.rollback()
+    return jsonify({'error': 'Database error'}), 500
+
+def handle_unexpected_error(e):
+    """Return a generic JSON 500 for an unhandled exception, which Flask has logged"""
+    db.session.rollback()
+    return jsonify({'error': 'Internal server error'}), 500
+
+def register_error_handlers(blueprint):
+    """Attach the shared API error handlers to a blueprint"""
+    blueprint.register_error_handler(404, handle_not_found)
+    blueprint.register_error_handler(HTTPException, handle_http_error)
+    blueprint.register_error_handler(msgspec.DecodeError, handle_invalid_payload)
+    blueprint.register_error_handler(IntegrityError, handle_integrity_error)
+    blueprint.register_error_handler(SQLAlchemyError, handle_database_error)
+    # Registered for 500 rather than Exception, so the app-level handlers
+    # flask-jwt-extended installs for auth errors still take precedence
+    blueprint.register_error_handler(500, handle_unexpected_error)
@@ -1,229 +1,330 @@
 
-from flask import Blueprint, jsonify, request
-from flask_jwt_extended import jwt_required, get_jwt_identity
-from src.models.user import User, Role, db
-from functools import wraps
+import msgspec
+from typing import Annotated
+from flask import Blueprint, jsonify, request, url_for
+from flask_jwt_extended import current_user
+from sqlalchemy import select, func, insert, delete, or_
+from sqlalchemy.orm import selectinload
+from src.models.user import (
+    User, Role, db, user_roles, load_user, hash_password, raiseload_guard
+)
+from src.security import require_permission
+from src.routes.errors import register_error_handlers
 
 user_bp = Blueprint('user', __name__)
+register_error_handlers(user_bp)
 
-def require_permission(permission_name):
-    """Decorator to check if user has required permission"""
-    def decorator(f):
-        @wraps(f)
-        @jwt_required()
-        def decorated_function(*args, **kwargs):
-            user_id = int(get_jwt_identity())  # Convert to int
-            user = User.query.get(user_id)
-            
-            if not user:
-                return jsonify({'error': 'User not found'}), 404
-            
-            if not user.has_permission(permission_name):
-                return jsonify({'error': 'Insufficient permissions'}), 403
-            
-            return f(*args, **kwargs)
-        return decorated_function
-    return decorator
+NonEmptyStr = Annotated[str, msgspec.Meta(min_length=1)]
+
+class CreateUserIn(msgspec.Struct):
+    """Request body for creating a user"""
+    username: NonEmptyStr
+    email: NonEmptyStr
+    password: NonEmptyStr
+    first_name: str | None = ''
+    last_name: str | None = ''
+    is_active: bool = True
+    role_ids: list[int] | None = None
+
+class UpdateUserIn(msgspec.Struct):
+    """Request body for updating a user; fields left out are not changed"""
+    username: NonEmptyStr | msgspec.UnsetType = msgspec.UNSET
+    email: NonEmptyStr | msgspec.UnsetType = msgspec.UNSET
+    password: str | None = None
+    first_name: str | None | msgspec.UnsetType = msgspec.UNSET
+    last_name: str | None | msgspec.UnsetType = msgspec.UNSET
+    is_active: bool | msgspec.UnsetType = msgspec.UNSET
+    role_ids: list[int] | None | msgspec.UnsetType = msgspec.UNSET
+
+class AssignRolesIn(msgspec.Struct):
+    """Request body for assigning several roles to a user"""
+    role_ids: Annotated[list[int], msgspec.Meta(min_length=1)]
+
+def find_missing_roles(role_ids):
+    """Return the requested role ids that don't exist, fetching ids only"""
+    if not role_ids:
+        return []
+    existing = set(db.session.scalars(select(Role.id).where(Role.id.in_(role_ids))))
+    return sorted(set(role_ids) - existing)
+
+def find_user_conflict(username, email):
+    """Return the error for a username or email already in use, ignoring case, or None"""
+    username_taken = db.session.scalar(
+        select(func.lower(User.username) == func.lower(username)).where(or_(
+            func.lower(User.username) == func.lower(username),
+            func.lower(User.email) == func.lower(email)
+        )).limit(1)
+    )
+    if username_taken is None:
+        return None
+    return 'Username already exists' if username_taken else 'Email already exists'
+
+def add_user_roles(user_id, role_ids):
+    """Link roles to a user in one INSERT, skipping existing links; returns how many were added"""
+    result = db.session.execute(insert(user_roles).prefix_with('OR IGNORE'), [
+        {'user_id': user_id, 'role_id': role_id} for role_id in role_ids
+    ])
+    return result.rowcount
+
+def wants_representation():
+    """Check whether the client sent Prefer: return=representation (RFC 7240)"""
+    return 'return=representation' in request.headers.get('Prefer', '')
+
+def written_user(user_id):
+    """Serialize a user after a write: id and username unless ?include=roles asks for more"""
+    if 'roles' in request.args.get('include', '').split(','):
+        return load_user(user_id).to_dict(include_roles=True)
+    return db.session.get(User, user_id).to_dict(minimal=True)
 
 @user_bp.route('/users', methods=['GET'])
 @require_permission('user_read')
 def get_users():
     """Get all users (Admin/HR only)"""
-    try:
+    per_page = max(request.args.get('per_page', 10, type=int), 1)
+    query = User.query.options(
+        selectinload(User.roles).selectinload(Role.permissions), *raiseload_guard()
+    ).order_by(User.id)
+    # Users share a few roles, so each is serialized once for the whole page
+    role_summaries = {}
+    
+    if 'page' in request.args:
+        # Offset pagination, kept for clients that jump to numbered pages
         page = request.args.get('page', 1, type=int)
-        per_page = request.args.get('per_page', 10, type=int)
-        
-        users = User.query.paginate(
-            page=page, per_page=per_page, error_out=False
-        )
+        users = query.paginate(page=page, per_page=per_page, error_out=False)
         
         return jsonify({
-            'users': [user.to_dict(include_roles=True) for user in users.items],
+            'users': [
+                user.to_dict(include_roles=True, role_summaries=role_summaries)
+                for user in users.items
+            ],
             'total': users.total,
             'pages': users.pages,
             'current_page': page
         }), 200
-        
-    except Exception as e:
-        return jsonify({'error': str(e)}), 500
+    
+    # Keyset pagination: seek past the last seen id instead of scanning an
+    # OFFSET, fetching one extra row to know whether another page exists
+    after_id = request.args.get('after_id', 0, type=int)
+    users = query.filter(User.id > after_id).limit(per_page + 1).all()
+    has_more = len(users) > per_page
+    users = users[:per_page]
+    
+    result = {
+        'users': [
+            user.to_dict(include_roles=True, role_summaries=role_summaries) for user in users
+        ],
+        'next_cursor': users[-1].id if has_more else None
+    }
+    
+    # Counting scans the whole table, so only do it on request
+    if request.args.get('include_total', 0, type=int):
+        result['total'] = db.session.scalar(select(func.count(User.id)))
+    
+    return jsonify(result), 200
 
 @user_bp.route('/users', methods=['POST'])
 @require_permission('user_write')
 def create_user():
     """Create a new user (Admin/HR only)"""
-    try:
-        data = request.get_json()
-        
-        # Validate required fields
-        required_fields = ['username', 'email', 'password']
-        for field in required_fields:
-            if not data.get(field):
-                return jsonify({'error': f'{field} is required'}), 400
-        
-        # Check if user already exists
-        if User.query.filter_by(username=data['username']).first():
-            return jsonify({'error': 'Username already exists'}), 400
-        
-        if User.query.filter_by(email=data['email']).first():
-            return jsonify({'error': 'Email already exists'}), 400
-        
-        # Create new user
-        user = User(
-            username=data['username'],
-            email=data['email'],
-            first_name=data.get('first_name', ''),
-            last_name=data.get('last_name', ''),
-            is_active=data.get('is_active', True)
-        )
-        user.set_password(data['password'])
-        
-        # Assign roles if provided
-        if 'role_ids' in data:
-            roles = Role.query.filter(Role.id.in_(data['role_ids'])).all()
-            user.roles = roles
-        
-        db.session.add(user)
-        db.session.commit()
-        
-        return jsonify({
-            'message': 'User created successfully',
-            'user': user.to_dict(include_roles=True)
-        }), 201
-        
-    except Exception as e:
-        db.session.rollback()
-        return jsonify({'error': str(e)}), 500
+    # Decoding validates required fields and types; the blueprint turns a
+    # msgspec error into a 400
+    data = msgspec.json.decode(request.get_data(), type=CreateUserIn)
+    
+    # Reject unknown roles up front instead of silently dropping them
+    role_ids = list(dict.fromkeys(data.role_ids or []))
+    missing_roles = find_missing_roles(role_ids)
+    if missing_roles:
+        return jsonify({'error': f'Roles not found: {missing_roles}'}), 400
+    
+    # Probe for a clash before hashing, so a duplicate is turned away without
+    # paying for an Argon2 hash
+    conflict = find_user_conflict(data.username, data.email)
+    if conflict:
+        return jsonify({'error': conflict}), 400
+    
+    # Create new user; OR IGNORE still skips the row if a concurrent request
+    # took the username or email since the probe
+    user_id = db.session.scalar(
+        insert(User).prefix_with('OR IGNORE').values(
+            username=data.username,
+            email=data.email,
+            password=hash_password(data.password),
+            first_name=data.first_name,
+            last_name=data.last_name,
+            is_active=data.is_active
+        ).returning(User.id)
+    )
+    
+    if user_id is None:
+        conflict = find_user_conflict(data.username, data.email)
+        return jsonify({'error': conflict or 'User already exists'}), 400
+    
+    # Assign roles if provided, writing the association rows directly
+    if role_ids:
+        db.session.execute(insert(user_roles), [
+            {'user_id': user_id, 'role_id': role_id} for role_id in role_ids
+        ])
+    
+    db.session.commit()
+    
+    # The new user is at Location; the body is only sent when asked for
+    headers = {'Location': url_for('.get_user', user_id=user_id)}
+    if not wants_representation():
+        return '', 201, headers
+    
+    headers['Preference-Applied'] = 'return=representation'
+    return jsonify({
+        'message': 'User created successfully',
+        'user': written_user(user_id)
+    }), 201, headers
 
 @user_bp.route('/users/<int:user_id>', methods=['GET'])
 @require_permission('user_read')
 def get_user(user_id):
     """Get a specific user (Admin/HR only)"""
-    try:
-        user = User.query.get_or_404(user_id)
-        return jsonify({'user': user.to_dict(include_roles=True)}), 200
-        
-    except Exception as e:
-        return jsonify({'error': str(e)}), 500
+    user = load_user(user_id)
+    if not user:
+        return jsonify({'error': 'User not found'}), 404
+    
+    return jsonify({'user': user.to_dict(include_roles=True)}), 200
 
 @user_bp.route('/users/<int:user_id>', methods=['PUT'])
 @require_permission('user_write')
 def update_user(user_id):
     """Update a user (Admin/HR only)"""
-    try:
-        user = User.query.get_or_404(user_id)
-        data = request.get_json()
-        
-        # Update allowed fields
-        if 'username' in data:
-            # Check if username is already taken by another user
-            existing_user = User.query.filter(User.username == data['username'], User.id != user_id).first()
-            if existing_user:
-                return jsonify({'error': 'Username already exists'}), 400
-            user.username = data['username']
-        
-        if 'email' in data:
-            # Check if email is already taken by another user
-            existing_user = User.query.filter(User.email == data['email'], User.id != user_id).first()
-            if existing_user:
-                return jsonify({'error': 'Email already exists'}), 400
-            user.email = data['email']
-        
-        if 'first_name' in data:
-            user.first_name = data['first_name']
-        
-        if 'last_name' in data:
-            user.last_name = data['last_name']
-        
-        if 'is_active' in data:
-            user.is_active = data['is_active']
-        
-        if 'password' in data and data['password']:
-            user.set_password(data['password'])
-        
-        # Update roles if provided
-        if 'role_ids' in data:
-            roles = Role.query.filter(Role.id.in_(data['role_ids'])).all()
-            user.roles = roles
-        
-        db.session.commit()
-        
-        return jsonify({
-            'message': 'User updated successfully',
-            'user': user.to_dict(include_roles=True)
-        }), 200
-        
-    except Exception as e:
-        db.session.rollback()
-        return jsonify({'error': str(e)}), 500
+    user = db.get_or_404(User, user_id)
+    data = msgspec.json.decode(request.get_data(), type=UpdateUserIn)
+    
+    if data.role_ids is not msgspec.UNSET:
+        role_ids = list(dict.fromkeys(data.role_ids or []))
+        missing_roles = find_missing_roles(role_ids)
+        if missing_roles:
+            return jsonify({'error': f'Roles not found: {missing_roles}'}), 400
+    
+    # Update allowed fields; a username or email taken by another user is
+    # rejected by its UNIQUE constraint when the changes are flushed
+    if data.username is not msgspec.UNSET:
+        user.username = data.username
+    
+    if data.email is not msgspec.UNSET:
+        user.email = data.email
+    
+    if data.first_name is not msgspec.UNSET:
+        user.first_name = data.first_name
+    
+    if data.last_name is not msgspec.UNSET:
+        user.last_name = data.last_name
+    
+    if data.is_active is not msgspec.UNSET:
+        user.is_active = data.is_active
+    
+    if data.password:
+        user.set_password(data.password)
+    
+    db.session.flush()
+    
+    # Update roles if provided, touching only the association rows that change
+    if data.role_ids is not msgspec.UNSET:
+        db.session.execute(delete(user_roles).where(
+            user_roles.c.user_id == user_id, user_roles.c.role_id.notin_(role_ids)
+        ))
+        if role_ids:
+            add_user_roles(user_id, role_ids)
+    
+    db.session.commit()
+    
+    if not wants_representation():
+        return '', 204
+    
+    return jsonify({
+        'message': 'User updated successfully',
+        'user': written_user(user_id)
+    }), 200, {'Preference-Applied': 'return=representation'}
 
 @user_bp.route('/users/<int:user_id>', methods=['DELETE'])
 @require_permission('user_delete')
 def delete_user(user_id):
     """Delete a user (Admin only)"""
-    try:
-        current_user_id = int(get_jwt_identity())  # Convert to int
-        
-        # Prevent users from deleting themselves
-        if current_user_id == user_id:
-            return jsonify({'error': 'Cannot delete your own account'}), 400
-        
-        user = User.query.get_or_404(user_id)
-        db.session.delete(user)
-        db.session.commit()
-        
-        return jsonify({'message': 'User deleted successfully'}), 200
-        
-    except Exception as e:
-        db.session.rollback()
-        return jsonify({'error': str(e)}), 500
+    # Prevent users from deleting themselves
+    if current_user.id == user_id:
+        return jsonify({'error': 'Cannot delete your own account'}), 400
+    
+    user = db.get_or_404(User, user_id)
+    db.session.delete(user)
+    db.session.commit()
+    
+    return jsonify({'message': 'User deleted successfully'}), 200
 
 @user_bp.route('/users/<int:user_id>/roles', methods=['POST'])
 @require_permission('user_write')
 def assign_role_to_user(user_id):
     """Assign a role to a user (Admin/HR only)"""
-    try:
-        user = User.query.get_or_404(user_id)
-        data = request.get_json()
-        
-        if not data.get('role_id'):
-            return jsonify({'error': 'role_id is required'}), 400
-        
-        role = Role.query.get_or_404(data['role_id'])
+    user = db.get_or_404(User, user_id)
+    data = request.get_json()
+    
+    if not data.get('role_id'):
+        return jsonify({'error': 'role_id is required'}), 400
+    
+    role = db.get_or_404(Role, data['role_id'])
+    
+    # Let the composite primary key skip duplicates instead of loading user.roles
+    if add_user_roles(user_id, [role.id]):
+        message = f'Role {role.name} assigned to user {user.username}'
+        db.session.commit()
         
-        if role not in user.roles:
-            user.roles.append(role)
-            db.session.commit()
-            
-            return jsonify({
-                'message': f'Role {role.name} assigned to user {user.username}',
-                'user': user.to_dict(include_roles=True)
-            }), 200
-        else:
-            return jsonify({'error': 'User already has this role'}), 400
-            
-    except Exception as e:
-        db.session.rollback()
-        return jsonify({'error': str(e)}), 500
+        return jsonify({
+            'message': message,
+            'user': written_user(user_id)
+        }), 200
+    else:
+        return jsonify({'error': 'User already has this role'}), 400
+
+@user_bp.route('/users/<int:user_id>/roles:batch', methods=['POST'])
+@require_permission('user_write')
+def assign_roles_to_user(user_id):
+    """Assign several roles to a user in one transaction (Admin/HR only)"""
+    user = db.get_or_404(User, user_id)
+    data = msgspec.json.decode(request.get_data(), type=AssignRolesIn)
+    role_ids = list(dict.fromkeys(data.role_ids))
+    
+    missing_roles = find_missing_roles(role_ids)
+    if missing_roles:
+        return jsonify({'error': f'Roles not found: {missing_roles}'}), 400
+    
+    added = add_user_roles(user_id, role_ids)
+    message = f'{added} role(s) assigned to user {user.username}'
+    db.session.commit()
+    
+    return jsonify({
+        'message': message,
+        'user': written_user(user_id)
+    }), 200
 
 @user_bp.route('/users/<int:user_id>/roles/<int:role_id>', methods=['DELETE'])
 @require_permission('user_write')
 def remove_role_from_user(user_id, role_id):
     """Remove a role from a user (Admin/HR only)"""
-    try:
-        user = User.query.get_or_404(user_id)
-        role = Role.query.get_or_404(role_id)
+    # Delete first; the user and role only need reading to word the reply
+    result = db.session.execute(
+        delete(user_roles).where(
+            user_roles.c.user_id == user_id,
+            user_roles.c.role_id == role_id
+        )
+    )
+    
+    if result.rowcount:
+        username, role_name = db.session.execute(select(
+            select(User.username).where(User.id == user_id).scalar_subquery(),
+            select(Role.name).where(Role.id == role_id).scalar_subquery()
+        )).one()
+        message = f'Role {role_name} removed from user {username}'
+        db.session.commit()
         
-        if role in user.roles:
-            user.roles.remove(role)
-            db.session.commit()
-            
-            return jsonify({
-                'message': f'Role {role.name} removed from user {user.username}',
-                'user': user.to_dict(include_roles=True)
-            }), 200
-        else:
-            return jsonify({'error': 'User does not have this role'}), 400
-            
-    except Exception as e:
-        db.session.rollback()
-        return jsonify({'error': str(e)}), 500
\ No newline at end of file
+        return jsonify({
+            'message': message,
+            'user': written_user(user_id)
+        }), 200
+    else:
+        db.get_or_404(User, user_id)
+        db.get_or_404(Role, role_id)
+        return jsonify({'error': 'User does not have this role'}), 400
\ No newline at end of file
@@ -0,0 +1,22 @@
+from flask import g, jsonify
+from flask_jwt_extended import jwt_required, current_user
+from functools import wraps
+
+def current_permissions():
+    """Get the current user's permission names, resolved once per request"""
+    if 'user_permissions' not in g:
+        g.user_permissions = frozenset(current_user.get_permissions())
+    return g.user_permissions
+
+def require_permission(permission_name):
+    """Decorator to check if user has required permission"""
+    def decorator(f):
+        @wraps(f)
+        @jwt_required()
+        def decorated_function(*args, **kwargs):
+            if not (current_user.is_admin or permission_name in current_permissions()):
+                return jsonify({'error': 'Insufficient permissions'}), 403
+            
+            return f(*args, **kwargs)
+        return decorated_function
+    return decorator
@@ -3,83 +3,66 @@ Database seeding script to create initial admin user and sample data
 """
 import os
 import sys
+from collections import namedtuple
 sys.path.insert(0, os.path.dirname(os.path.dirname(__file__)))
 
-from src.models.user import db, User, Role, Permission
+from sqlalchemy import select, insert
+from src.models.user import db, User, Role, user_roles, hash_passwords
 
-def seed_admin_user():
-    """Create initial admin user"""
-    # Check if admin user already exists
-    admin_user = User.query.filter_by(username='admin').first()
-    if admin_user:
-        print("Admin user already exists")
-        return
+SeedUser = namedtuple('SeedUser', 'label username email first_name last_name password role')
+
+SEED_USERS = [
+    SeedUser('Admin', 'admin', 'admin@hrms.com', 'System', 'Administrator', 'admin123', 'Admin'),  # Change this in production
+    SeedUser('HR Manager', 'hr_manager', 'hr@hrms.com', 'HR', 'Manager', 'hr123', 'HR'),
+    SeedUser('Employee', 'john_doe', 'john.doe@hrms.com', 'John', 'Doe', 'employee123', 'Employee'),
+]
+
+def seed_users():
+    """Create the initial admin user and sample HR and Employee users"""
+    # One query each for the roles and the users that already exist
+    roles = dict(db.session.execute(
+        select(Role.name, Role.id).where(Role.name.in_([u.role for u in SEED_USERS]))
+    ).all())
+    existing_users = set(db.session.scalars(
+        select(User.username).where(User.username.in_([u.username for u in SEED_USERS]))
+    ))
     
-    # Get admin role
-    admin_role = Role.query.filter_by(name='Admin').first()
-    if not admin_role:
-        print("Admin role not found. Please run the application first to initialize roles.")
+    new_users = []
+    for seed_user in SEED_USERS:
+        if seed_user.username in existing_users:
+            print(f"{seed_user.label} user already exists")
+        elif seed_user.role not in roles:
+            print(f"{seed_user.role} role not found. Please run the application first to initialize roles.")
+        else:
+            new_users.append(seed_user)
+    if not new_users:
         return
     
-    # Create admin user
-    admin_user = User(
-        username='admin',
-        email='admin@hrms.com',
-        first_name='System',
-        last_name='Administrator',
-        is_active=True
-    )
-    admin_user.set_password('admin123')  # Change this in production
-    admin_user.roles.append(admin_role)
+    # Hash all passwords at once so they run in parallel on the hashing pool
+    password_hashes = hash_passwords([u.password for u in new_users])
     
-    db.session.add(admin_user)
+    # Insert the users and their role links with one statement each
+    user_ids = db.session.scalars(
+        insert(User).returning(User.id, sort_by_parameter_order=True),
+        [
+            {'username': u.username, 'email': u.email, 'first_name': u.first_name,
+             'last_name': u.last_name, 'password': password_hash, 'is_active': True}
+            for u, password_hash in zip(new_users, password_hashes)
+        ]
+    ).all()
+    db.session.execute(insert(user_roles), [
+        {'user_id': user_id, 'role_id': roles[u.role]} for user_id, u in zip(user_ids, new_users)
+    ])
     db.session.commit()
     
-    print("Admin user created successfully!")
-    print("Username: admin")
-    print("Password: admin123")
-    print("Email: admin@hrms.com")
-
-def seed_sample_users():
-    """Create sample HR and Employee users"""
-    # HR User
-    hr_role = Role.query.filter_by(name='HR').first()
-    if hr_role and not User.query.filter_by(username='hr_manager').first():
-        hr_user = User(
-            username='hr_manager',
-            email='hr@hrms.com',
-            first_name='HR',
-            last_name='Manager',
-            is_active=True
-        )
-        hr_user.set_password('hr123')
-        hr_user.roles.append(hr_role)
-        db.session.add(hr_user)
-        print("HR Manager user created: hr_manager / hr123")
-    
-    # Employee User
-    employee_role = Role.query.filter_by(name='Employee').first()
-    if employee_role and not User.query.filter_by(username='john_doe').first():
-        employee_user = User(
-            username='john_doe',
-            email='john.doe@hrms.com',
-            first_name='John',
-            last_name='Doe',
-            is_active=True
-        )
-        employee_user.set_password('employee123')
-        employee_user.roles.append(employee_role)
-        db.session.add(employee_user)
-        print("Employee user created: john_doe / employee123")
-    
-    db.session.commit()
+    for u in new_users:
+        print(f"{u.label} user created: {u.username} / {u.password}")
 
 if __name__ == '__main__':
     from src.main import app
     
     with app.app_context():
-        seed_admin_user()
-        seed_sample_users()
+        seed_users()
         print("\nDatabase seeding completed!")
         print("\nDefault users:")
         print("1. Admin: admin / admin123")